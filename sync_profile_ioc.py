@@ -1,117 +1,234 @@
 #!/usr/bin/env python3
 
 import argparse
+import copy
+import functools
+import hashlib
+import itertools
+import json
+import os
+import queue
 import time
 import threading
 import numpy as np
 import logging
+from collections import deque
 from softioc import softioc, builder
 import epics
 import yaml
-import xml.etree.ElementTree as ET
-import xml.dom.minidom
-
-def main():
-    parser = argparse.ArgumentParser(description='EPICS Soft IOC for synchronization profile')
-    parser.add_argument('--config', required=True, help='YAML config file with devices to monitor')
-    parser.add_argument("-p", "--pvout", required=False, default="pvlist.txt", help="Output PV list file")
-    parser.add_argument("--prefix", default="SYNC", help="IOC prefix for PV names")
-    parser.add_argument("--bob", default="sync_profile.bob", help="Output Phoebus .bob file")
-    parser.add_argument("--polling-freq", type=float, help="Polling frequency in Hz, if not given use monitoring")
-    parser.add_argument("--iocname", help="IOC name to display as title")
-    parser.add_argument("--loglevel", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"], help="Logging level")
-    parser.add_argument("--create-display-only", action="store_true", help="Create Phoebus display file and exit without running IOC")
-    args = parser.parse_args()
-
-    logging.basicConfig(level=getattr(logging, args.loglevel.upper()), format='%(asctime)s - %(levelname)s - %(message)s')
-
-    with open(args.config) as f:
-        config = yaml.safe_load(f)
-    devices = config['devices']
-    names = [d['name'] for d in devices]
-    pvs = [d['pv'] for d in devices]
-    name_to_pv = {d['name']: d['pv'] for d in devices}
-    pv_to_name = {d['pv']: d['name'] for d in devices}
-
-    logging.info(f"Loaded {len(devices)} devices from {args.config}")
-    logging.info("Monitoring PVs:")
-    for name, pv in zip(names, pvs):
-        logging.info(f"  {name}: {pv}")
-    logging.info(f"IOC prefix: {args.prefix}")
-    logging.info(f"Output PV list file: {args.pvout}")
-    if args.polling_freq:
-        logging.info(f"Mode: Polling at {args.polling_freq} Hz")
-    else:
-        logging.info("Mode: Monitoring")
-
-    num_pvs = len(pvs)
-    data = {pv: {'times': [], 'freqs': []} for pv in pvs}
-    window_size = 100  # Number of samples for stats
-
-    # Set device name
-    builder.SetDeviceName(args.prefix)
-
-    # Create PVs for each input PV stats
-    freq_pvs = {}
-    timestamp_pvs = {}
-    for name in names:
-        freq_pvs[name] = {
-            'instant': builder.aIn(f'{name}:InstantFreq', initial_value=0.0, PREC=6),
-            'avg': builder.aIn(f'{name}:AvgFreq', initial_value=0.0, PREC=6),
-            'min': builder.aIn(f'{name}:MinFreq', initial_value=0.0, PREC=6),
-            'max': builder.aIn(f'{name}:MaxFreq', initial_value=0.0, PREC=6),
-            'std': builder.aIn(f'{name}:StdFreq', initial_value=0.0, PREC=6),
-        }
-        timestamp_pvs[name] = builder.aIn(f'{name}:Timestamp', initial_value=0.0, PREC=6)
-
-    # Create PVs for time diffs between PVs
-    diff_pvs = {}
-    for i in range(num_pvs):
-        for j in range(i+1, num_pvs):
-            name1 = names[i]
-            name2 = names[j]
-            pair_name = f'{name1}_vs_{name2}'
-            diff_pvs[(i, j)] = {
-                'current': builder.aIn(f'{pair_name}:CurrentDiff', initial_value=0.0, PREC=6),
-                'avg': builder.aIn(f'{pair_name}:AvgDiff', initial_value=0.0, PREC=6),
-                'min': builder.aIn(f'{pair_name}:MinDiff', initial_value=0.0, PREC=6),
-                'max': builder.aIn(f'{pair_name}:MaxDiff', initial_value=0.0, PREC=6),
-                'std': builder.aIn(f'{pair_name}:StdDiff', initial_value=0.0, PREC=6),
-            }
-
-    logging.info("Created output PVs:")
+from lxml import etree as ET
+
+log = logging.getLogger(__name__)
+
+try:
+    from numba import njit
+except ImportError:  # Numba is optional, pair stats then use NumPy broadcasting
+    njit = None
+
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:  # PyYAML built without libyaml
+    from yaml import SafeLoader as YamlLoader
+
+
+def load_config(path):
+    # Parsed configs are cached as JSON next to the YAML file, together with the YAML's
+    # mtime and size, and reused while both still match; an older mtime (e.g. a restored
+    # file) invalidates the cache just like a newer one. Only configs that survive the JSON
+    # round trip unchanged are cached, so a warm start returns the same data as a cold one
+    cache = path + '.cache.json'
+    st = os.stat(path)
+    key = [st.st_mtime_ns, st.st_size]
+    try:
+        with open(cache) as f:
+            cached = json.load(f)
+        if cached['key'] == key:
+            return cached['config']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    with open(path) as f:
+        config = yaml.load(f, Loader=YamlLoader)
+    tmp = f"{cache}.{os.getpid()}.tmp"
+    try:
+        data = json.dumps({'key': key, 'config': config})
+        if json.loads(data)['config'] != config:
+            raise ValueError("config is not representable as JSON")
+        with open(tmp, 'w') as f:
+            f.write(data)
+        os.replace(tmp, cache)
+    except (OSError, TypeError, ValueError) as e:
+        log.debug("Could not write config cache %s: %s", cache, e)
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+    return config
+
+
+def _make_pair_diff_stats_numpy(num_pvs, window_size, num_pairs):
+    # Work buffers are allocated once for the largest possible pair subset and every
+    # step writes into them, so the publisher does not churn (num_pairs, window_size)
+    # temporaries on each tick
+    slots = np.arange(window_size)
+    row_offsets = (np.arange(num_pvs) * window_size)[:, None]
+    order = np.empty((num_pvs, window_size), dtype=np.intp)
+    times = np.empty((num_pvs, window_size), dtype=np.int64)
+    times_a = np.empty((num_pairs, window_size), dtype=np.int64)
+    times_b = np.empty((num_pairs, window_size), dtype=np.int64)
+    diffs_buf = np.empty((num_pairs, window_size), dtype=np.float64)
+    valid = np.empty((num_pairs, window_size), dtype=bool)
+
+    def pair_diff_stats(times_buf, time_head, time_count, pair_i, pair_j, out):
+        # Rows are first unrolled oldest -> newest, so that the windows are right-aligned
+        # and paired by their most recent samples
+        np.add(time_head[:, None], slots, out=order)
+        np.remainder(order, window_size, out=order)
+        np.add(order, row_offsets, out=order)
+        np.take(times_buf, order, out=times)
+        num = len(pair_i)
+        np.take(times, pair_i, axis=0, out=times_a[:num])
+        np.take(times, pair_j, axis=0, out=times_b[:num])
+        # Differences are exact in integer nanoseconds and only then scaled to seconds
+        np.subtract(times_a[:num], times_b[:num], out=times_a[:num])
+        diffs = diffs_buf[:num]
+        np.multiply(times_a[:num], 1e-9, out=diffs)
+        # A pair only has as many paired samples as its shorter window
+        n_pair = np.minimum(time_count[pair_i], time_count[pair_j])
+        np.greater_equal(slots, (window_size - n_pair)[:, None], out=valid[:num])
+        n = np.maximum(n_pair, 1)
+        out[0] = diffs[:, -1]
+        np.sum(diffs, axis=-1, where=valid[:num], out=out[1])
+        out[1] /= n
+        np.min(diffs, axis=-1, where=valid[:num], initial=np.inf, out=out[2])
+        np.max(diffs, axis=-1, where=valid[:num], initial=-np.inf, out=out[3])
+        diffs -= out[1][:, None]
+        diffs *= diffs
+        np.sum(diffs, axis=-1, where=valid[:num], out=out[4])
+        out[4] /= n
+        np.sqrt(out[4], out=out[4])
+
+    return pair_diff_stats
+
+
+def _pair_diff_stats_loops(times_buf, time_head, time_count, pair_i, pair_j, out):
+    # Same results as the NumPy fallback, walking the ring buffers newest -> oldest in place
+    window_size = times_buf.shape[1]
+    for k in range(len(pair_i)):
+        i = pair_i[k]
+        j = pair_j[k]
+        n = min(time_count[i], time_count[j])
+        if n == 0:
+            continue
+        newest_i = (time_head[i] - 1) % window_size
+        newest_j = (time_head[j] - 1) % window_size
+        current = (times_buf[i, newest_i] - times_buf[j, newest_j]) * 1e-9
+        # One pass over the window: Welford's update keeps the running mean and the sum
+        # of squared deviations from it next to the min and max
+        avg = 0.0
+        sq = 0.0
+        min_diff = current
+        max_diff = current
+        a = newest_i
+        b = newest_j
+        for c in range(n):
+            d = (times_buf[i, a] - times_buf[j, b]) * 1e-9
+            delta = d - avg
+            avg += delta / (c + 1)
+            sq += delta * (d - avg)
+            min_diff = min(min_diff, d)
+            max_diff = max(max_diff, d)
+            a = a - 1 if a > 0 else window_size - 1
+            b = b - 1 if b > 0 else window_size - 1
+        out[0, k] = current
+        out[1, k] = avg
+        out[2, k] = min_diff
+        out[3, k] = max_diff
+        out[4, k] = np.sqrt(sq / n)
+
+
+if njit is not None:
+    # The kernel only touches buffers owned by the stats thread, so it runs without the
+    # GIL and the monitor callbacks are not held up meanwhile
+    _pair_diff_stats_jit = njit(nogil=True, cache=True, fastmath=True)(_pair_diff_stats_loops)
+
+
+def make_pair_diff_stats(num_pvs, window_size, num_pairs):
+    # The compiled loops need no work buffers; the NumPy fallback binds its own
+    if njit is not None:
+        return _pair_diff_stats_jit
+    return _make_pair_diff_stats_numpy(num_pvs, window_size, num_pairs)
+
+
+def timestamp_ns(timestamp, posixseconds, nanoseconds):
+    # Update time in integer nanoseconds, exact from the integer fields of the EPICS
+    # timestamp; a pyepics that does not pass them falls back on the float epoch time,
+    # which only resolves ~256 ns
+    if posixseconds is None or nanoseconds is None:
+        return round(timestamp * 1e9)
+    return posixseconds * 1_000_000_000 + nanoseconds
+
+
+# Version of the generated display layout, part of the .bob hash so that displays written
+# by an older layout are rebuilt
+DISPLAY_LAYOUT = 2
+
+# Output record suffixes, per input PV and per PV pair
+DEVICE_SUFFIXES = ('Timestamp', 'InstantFreq', 'AvgFreq', 'MinFreq', 'MaxFreq', 'StdFreq')
+PAIR_SUFFIXES = ('CurrentDiff', 'AvgDiff', 'MinDiff', 'MaxDiff', 'StdDiff')
+
+
+def output_pv_names(prefix, names, pair_names):
+    # Full names of all output PVs keyed by (device or pair name, suffix), in PV list order
+    full_names = {}
     for name in names:
-        logging.info(f"  Stats for {name}: {args.prefix}:{name}:Timestamp, InstantFreq, AvgFreq, MinFreq, MaxFreq, StdFreq")
-    for i in range(num_pvs):
-        for j in range(i+1, num_pvs):
-            name1 = names[i]
-            name2 = names[j]
-            pair_name = f'{name1}_vs_{name2}'
-            logging.info(f"  Time diff stats for {name1} vs {name2}: {args.prefix}:{pair_name}:CurrentDiff, AvgDiff, MinDiff, MaxDiff, StdDiff")
-
-    # Generate Phoebus .bob file
-    pv_list = []
-    for name in names:
-        pv_list.append(f"{args.prefix}:{name}:Timestamp")
-        pv_list.append(f"{args.prefix}:{name}:InstantFreq")
-        pv_list.append(f"{args.prefix}:{name}:AvgFreq")
-        pv_list.append(f"{args.prefix}:{name}:MinFreq")
-        pv_list.append(f"{args.prefix}:{name}:MaxFreq")
-        pv_list.append(f"{args.prefix}:{name}:StdFreq")
-    for i in range(num_pvs):
-        for j in range(i+1, num_pvs):
-            name1 = names[i]
-            name2 = names[j]
-            pair_name = f'{name1}_vs_{name2}'
-            pv_list.append(f"{args.prefix}:{pair_name}:CurrentDiff")
-            pv_list.append(f"{args.prefix}:{pair_name}:AvgDiff")
-            pv_list.append(f"{args.prefix}:{pair_name}:MinDiff")
-            pv_list.append(f"{args.prefix}:{pair_name}:MaxDiff")
-            pv_list.append(f"{args.prefix}:{pair_name}:StdDiff")
+        for suffix in DEVICE_SUFFIXES:
+            full_names[(name, suffix)] = f"{prefix}:{name}:{suffix}"
+    for pair_name in pair_names:
+        for suffix in PAIR_SUFFIXES:
+            full_names[(pair_name, suffix)] = f"{prefix}:{pair_name}:{suffix}"
+    return full_names
+
+
+def subtext(parent, tag, value):
+    # Child element `tag` of `parent` holding `value` as its text
+    element = ET.SubElement(parent, tag)
+    element.text = str(value)
+    return element
+
+
+def widget_template(widget_type, **texts):
+    # Widget holding the given text children in keyword order, to be copied by stamp()
+    widget = ET.Element("widget", type=widget_type, version="2.0.0")
+    for tag, value in texts.items():
+        subtext(widget, tag, value)
+    return widget
+
+
+def stamp(parent, template, **texts):
+    # Append a copy of `template` to `parent`, with the text of the given children replaced
+    widget = copy.deepcopy(template)
+    for tag, value in texts.items():
+        widget.find(tag).text = str(value)
+    parent.append(widget)
+    return widget
+
+
+def write_display(args, names, pvs, pair_names, full_names):
+    # The display only depends on these inputs; their hash is stored in a comment at the
+    # top of the file so an unchanged display is not rebuilt on every restart
+    inputs = json.dumps([DISPLAY_LAYOUT, names, pvs, args.prefix, args.iocname, args.polling_freq])
+    marker = f" sync-profile hash: {hashlib.blake2b(inputs.encode(), digest_size=16).hexdigest()} "
+    try:
+        with open(args.bob, encoding='utf-8') as f:
+            if f"<!--{marker}-->" in f.read(512):
+                log.info("Phoebus display file %s is up to date", args.bob)
+                return
+    except OSError:
+        pass
 
     root = ET.Element("display", version="2.0.0")
     display_name = args.iocname if args.iocname else "Sync Profile"
-    ET.SubElement(root, "name").text = display_name
+    subtext(root, "name", display_name)
     mode_text = "Mode: Monitoring"
     if args.polling_freq:
         mode_text = f"Mode: Polling at {args.polling_freq} Hz"
@@ -119,55 +236,62 @@ def main():
     x_start = 10
     y_start = 80  # Increased to leave more space after mode label
     row_height = 35
-    columns_device = ['Device', 'Timestamp', 'InstantFreq', 'AvgFreq', 'MinFreq', 'MaxFreq', 'StdFreq']
+    columns_device = ['Device', *DEVICE_SUFFIXES]
     widths_device = [180, 120, 120, 120, 120, 120, 120]
     width = x_start + sum(widths_device)  # for device table
     height = 1000  # approximate, will adjust
-    ET.SubElement(root, "width").text = str(width)
-    ET.SubElement(root, "height").text = str(height)
-    actions = ET.SubElement(root, "actions")
-    actions.text = ""
+    subtext(root, "width", width)
+    subtext(root, "height", height)
     # Add title label first
     title_label = ET.SubElement(root, "widget", type="label", version="2.0.0")
-    ET.SubElement(title_label, "name").text = "Title_Label"
-    ET.SubElement(title_label, "text").text = display_name
-    ET.SubElement(title_label, "x").text = "10"
-    ET.SubElement(title_label, "y").text = "10"
-    ET.SubElement(title_label, "width").text = str(width)
-    ET.SubElement(title_label, "height").text = "30"
-    ET.SubElement(title_label, "horizontal_alignment").text = "1"
-    ET.SubElement(title_label, "background_color").text = "#F0F0F0"
-    ET.SubElement(title_label, "foreground_color").text = "#0000FF"
+    subtext(title_label, "name", "Title_Label")
+    subtext(title_label, "text", display_name)
+    subtext(title_label, "x", "10")
+    subtext(title_label, "y", "10")
+    subtext(title_label, "width", width)
+    subtext(title_label, "height", "30")
+    subtext(title_label, "horizontal_alignment", "1")
+    subtext(title_label, "background_color", "#F0F0F0")
+    subtext(title_label, "foreground_color", "#0000FF")
     font = ET.SubElement(title_label, "font")
     ET.SubElement(font, "font", name="Liberation Sans", style="BOLD", size="26.0")
     # Add mode label after
     mode_label = ET.SubElement(root, "widget", type="label", version="2.0.0")
-    ET.SubElement(mode_label, "name").text = "Mode_Label"
-    ET.SubElement(mode_label, "text").text = mode_text
-    ET.SubElement(mode_label, "x").text = "10"
-    ET.SubElement(mode_label, "y").text = "40"
-    ET.SubElement(mode_label, "width").text = "400"
-    ET.SubElement(mode_label, "height").text = "25"
-    ET.SubElement(mode_label, "horizontal_alignment").text = "0"
-    ET.SubElement(mode_label, "background_color").text = "#E8F4FD"  # Light blue background
+    subtext(mode_label, "name", "Mode_Label")
+    subtext(mode_label, "text", mode_text)
+    subtext(mode_label, "x", "10")
+    subtext(mode_label, "y", "40")
+    subtext(mode_label, "width", "400")
+    subtext(mode_label, "height", "25")
+    subtext(mode_label, "horizontal_alignment", "0")
+    subtext(mode_label, "background_color", "#E8F4FD")  # Light blue background
     font = ET.SubElement(mode_label, "font")
     ET.SubElement(font, "font", name="Liberation Sans", style="BOLD", size="14.0")
 
+    # Table rows only differ in these placeholder fields, the rest is copied from the templates
+    row_label = widget_template("label", name="", text="", x="", y="", width="", height=30,
+                                horizontal_alignment=1)
+    row_textupdate = widget_template("textupdate", name="", pv_name="", x="", y="", width="", height=30,
+                                     horizontal_alignment=1, vertical_alignment=1, wrap_words="false",
+                                     precision=6, border_width=1)
+
     # Device stats table
     y = y_start
+    # Left edge of each column
+    xs_device = list(itertools.accumulate([x_start, *widths_device]))
     for col_idx, col in enumerate(columns_device):
         width_col = widths_device[col_idx]
-        x = x_start + sum(widths_device[:col_idx])
+        x = xs_device[col_idx]
         # Column label
         label = ET.SubElement(root, "widget", type="label", version="2.0.0")
-        ET.SubElement(label, "name").text = f"Label_Device_{col}"
-        ET.SubElement(label, "text").text = col
-        ET.SubElement(label, "x").text = str(x)
-        ET.SubElement(label, "y").text = "65"  # Adjusted y
-        ET.SubElement(label, "width").text = str(width_col - 10)
-        ET.SubElement(label, "height").text = "30"
-        ET.SubElement(label, "horizontal_alignment").text = "1"
-        ET.SubElement(label, "background_color").text = "#D3D3D3"  # Light gray
+        subtext(label, "name", f"Label_Device_{col}")
+        subtext(label, "text", col)
+        subtext(label, "x", x)
+        subtext(label, "y", "65")  # Adjusted y
+        subtext(label, "width", width_col - 10)
+        subtext(label, "height", "30")
+        subtext(label, "horizontal_alignment", "1")
+        subtext(label, "background_color", "#D3D3D3")  # Light gray
         font = ET.SubElement(label, "font")
         ET.SubElement(font, "font", name="Liberation Sans", style="BOLD", size="12.0")
         # Rows
@@ -175,241 +299,418 @@ def main():
             yy = y + row_idx * row_height
             if col == 'Device':
                 # Label for device name
-                dev_label = ET.SubElement(root, "widget", type="label", version="2.0.0")
-                ET.SubElement(dev_label, "name").text = f"Label_Device_{name}"
-                ET.SubElement(dev_label, "text").text = name
-                ET.SubElement(dev_label, "x").text = str(x)
-                ET.SubElement(dev_label, "y").text = str(yy)
-                ET.SubElement(dev_label, "width").text = str(width_col - 10)
-                ET.SubElement(dev_label, "height").text = "30"
-                ET.SubElement(dev_label, "horizontal_alignment").text = "1"
+                stamp(root, row_label, name=f"Label_Device_{name}", text=name, x=x, y=yy, width=width_col - 10)
             else:
-                pv = f"{args.prefix}:{name}:{col}"
-                widget = ET.SubElement(root, "widget", type="textupdate", version="2.0.0")
-                ET.SubElement(widget, "name").text = f"TextUpdate_{name}_{col}"
-                ET.SubElement(widget, "pv_name").text = pv
-                ET.SubElement(widget, "x").text = str(x)
-                ET.SubElement(widget, "y").text = str(yy)
-                ET.SubElement(widget, "width").text = str(width_col - 10)
-                ET.SubElement(widget, "height").text = "30"
-                ET.SubElement(widget, "horizontal_alignment").text = "1"
-                ET.SubElement(widget, "vertical_alignment").text = "1"
-                ET.SubElement(widget, "wrap_words").text = "false"
-                ET.SubElement(widget, "precision").text = "6"
-                actions = ET.SubElement(widget, "actions")
-                actions.text = ""
-                ET.SubElement(widget, "border_width").text = "1"
+                stamp(root, row_textupdate, name=f"TextUpdate_{name}_{col}", pv_name=full_names[(name, col)],
+                      x=x, y=yy, width=width_col - 10)
 
     # Diff stats table
     y_diff = y + len(names) * row_height + 50
-    columns_diff = ['Pair', 'CurrentDiff', 'AvgDiff', 'MinDiff', 'MaxDiff', 'StdDiff']
+    columns_diff = ['Pair', *PAIR_SUFFIXES]
     widths_diff = [180, 120, 120, 120, 120, 120]
+    xs_diff = list(itertools.accumulate([x_start, *widths_diff]))
     for col_idx, col in enumerate(columns_diff):
         width_col = widths_diff[col_idx]
-        x = x_start + sum(widths_diff[:col_idx])
+        x = xs_diff[col_idx]
         # Column label
         label = ET.SubElement(root, "widget", type="label", version="2.0.0")
-        ET.SubElement(label, "name").text = f"Label_Diff_{col}"
-        ET.SubElement(label, "text").text = col
-        ET.SubElement(label, "x").text = str(x)
-        ET.SubElement(label, "y").text = str(y_diff - 30)
-        ET.SubElement(label, "width").text = str(width_col - 10)
-        ET.SubElement(label, "height").text = "30"
-        ET.SubElement(label, "horizontal_alignment").text = "1"
-        ET.SubElement(label, "background_color").text = "#D3D3D3"
+        subtext(label, "name", f"Label_Diff_{col}")
+        subtext(label, "text", col)
+        subtext(label, "x", x)
+        subtext(label, "y", y_diff - 30)
+        subtext(label, "width", width_col - 10)
+        subtext(label, "height", "30")
+        subtext(label, "horizontal_alignment", "1")
+        subtext(label, "background_color", "#D3D3D3")
         font = ET.SubElement(label, "font")
         ET.SubElement(font, "font", name="Liberation Sans", style="BOLD", size="12.0")
         # Rows
-        pairs = [f'{names[i]}_vs_{names[j]}' for i in range(num_pvs) for j in range(i+1, num_pvs)]
-        for row_idx, pair in enumerate(pairs):
+        for row_idx, pair in enumerate(pair_names):
             yy = y_diff + row_idx * row_height
             if col == 'Pair':
                 # Label for pair name
-                pair_label = ET.SubElement(root, "widget", type="label", version="2.0.0")
-                ET.SubElement(pair_label, "name").text = f"Label_Pair_{pair}"
-                ET.SubElement(pair_label, "text").text = pair.replace('_vs_', ' vs ')
-                ET.SubElement(pair_label, "x").text = str(x)
-                ET.SubElement(pair_label, "y").text = str(yy)
-                ET.SubElement(pair_label, "width").text = str(width_col - 10)
-                ET.SubElement(pair_label, "height").text = "30"
-                ET.SubElement(pair_label, "horizontal_alignment").text = "1"
+                stamp(root, row_label, name=f"Label_Pair_{pair}", text=pair.replace('_vs_', ' vs '),
+                      x=x, y=yy, width=width_col - 10)
             else:
-                pv = f"{args.prefix}:{pair}:{col}"
-                widget = ET.SubElement(root, "widget", type="textupdate", version="2.0.0")
-                ET.SubElement(widget, "name").text = f"TextUpdate_{pair}_{col}"
-                ET.SubElement(widget, "pv_name").text = pv
-                ET.SubElement(widget, "x").text = str(x)
-                ET.SubElement(widget, "y").text = str(yy)
-                ET.SubElement(widget, "width").text = str(width_col - 10)
-                ET.SubElement(widget, "height").text = "30"
-                ET.SubElement(widget, "horizontal_alignment").text = "1"
-                ET.SubElement(widget, "vertical_alignment").text = "1"
-                ET.SubElement(widget, "wrap_words").text = "false"
-                ET.SubElement(widget, "precision").text = "6"
-                actions = ET.SubElement(widget, "actions")
-                actions.text = ""
-                ET.SubElement(widget, "border_width").text = "1"
+                stamp(root, row_textupdate, name=f"TextUpdate_{pair}_{col}", pv_name=full_names[(pair, col)],
+                      x=x, y=yy, width=width_col - 10)
 
     # Input values table
-    input_y = y_diff + len(pairs) * row_height + 50
+    input_y = y_diff + len(pair_names) * row_height + 50
     header_label = ET.SubElement(root, "widget", type="label", version="2.0.0")
-    ET.SubElement(header_label, "name").text = "Header_Input"
-    ET.SubElement(header_label, "text").text = "Input Values"
-    ET.SubElement(header_label, "x").text = "10"
-    ET.SubElement(header_label, "y").text = str(input_y - 40)
-    ET.SubElement(header_label, "width").text = "360"
-    ET.SubElement(header_label, "height").text = "30"
-    ET.SubElement(header_label, "horizontal_alignment").text = "1"
-    ET.SubElement(header_label, "background_color").text = "#D3D3D3"
+    subtext(header_label, "name", "Header_Input")
+    subtext(header_label, "text", "Input Values")
+    subtext(header_label, "x", "10")
+    subtext(header_label, "y", input_y - 40)
+    subtext(header_label, "width", "360")
+    subtext(header_label, "height", "30")
+    subtext(header_label, "horizontal_alignment", "1")
+    subtext(header_label, "background_color", "#D3D3D3")
     font = ET.SubElement(header_label, "font")
     ET.SubElement(font, "font", name="Liberation Sans", style="BOLD", size="14.0")
 
     for i, (name, pv) in enumerate(zip(names, pvs)):
         # Label for device name
-        label = ET.SubElement(root, "widget", type="label", version="2.0.0")
-        ET.SubElement(label, "name").text = f"Label_Device_{name}"
-        ET.SubElement(label, "text").text = name
-        ET.SubElement(label, "x").text = "10"
-        ET.SubElement(label, "y").text = str(input_y)
-        ET.SubElement(label, "width").text = "150"
-        ET.SubElement(label, "height").text = "30"
-        ET.SubElement(label, "horizontal_alignment").text = "1"
+        stamp(root, row_label, name=f"Label_Device_{name}", text=name, x=10, y=input_y, width=150)
         # Textupdate for value
-        widget = ET.SubElement(root, "widget", type="textupdate", version="2.0.0")
-        ET.SubElement(widget, "name").text = f"TextUpdate_Input_{name}"
-        ET.SubElement(widget, "pv_name").text = pv
-        ET.SubElement(widget, "x").text = "170"
-        ET.SubElement(widget, "y").text = str(input_y)
-        ET.SubElement(widget, "width").text = "200"
-        ET.SubElement(widget, "height").text = "30"
-        ET.SubElement(widget, "horizontal_alignment").text = "1"
-        ET.SubElement(widget, "vertical_alignment").text = "1"
-        ET.SubElement(widget, "wrap_words").text = "false"
-        ET.SubElement(widget, "precision").text = "6"
-        actions = ET.SubElement(widget, "actions")
-        actions.text = ""
-        ET.SubElement(widget, "border_width").text = "1"
+        stamp(root, row_textupdate, name=f"TextUpdate_Input_{name}", pv_name=pv, x=170, y=input_y, width=200)
         input_y += 35
 
     # Update height
     final_height = input_y + 50
-    ET.SubElement(root, "height").text = str(final_height)
-
-    tree = ET.ElementTree(root)
-    rough_string = ET.tostring(root, encoding='unicode')
-    dom = xml.dom.minidom.parseString(rough_string)
-    pretty_xml = dom.toprettyxml(indent="  ")
-    # Replace the XML declaration to include encoding
-    pretty_xml = pretty_xml.replace('<?xml version="1.0" ?>', '<?xml version="1.0" encoding="UTF-8"?>')
-    # Remove extra newlines
-    lines = pretty_xml.split('\n')
-    non_empty_lines = [line for line in lines if line.strip()]
-    pretty_xml = '\n'.join(non_empty_lines) + '\n'
-    logging.info(f"Generated Phoebus display file: {args.bob}")
-
-    with open(args.bob, 'w', encoding='utf-8') as f:
-        f.write(pretty_xml)
+    subtext(root, "height", final_height)
+
+    # lxml indents while serializing, no need to reparse the document to pretty-print it
+    root.addprevious(ET.Comment(marker))
+    ET.ElementTree(root).write(args.bob, pretty_print=True, xml_declaration=True, encoding='UTF-8')
+    log.info("Generated Phoebus display file: %s", args.bob)
+
+
+def positive_float(text):
+    # argparse type for rates, which are used as divisors
+    value = float(text)
+    if not value > 0:
+        raise argparse.ArgumentTypeError(f"must be a positive number, got {text}")
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description='EPICS Soft IOC for synchronization profile')
+    parser.add_argument('--config', required=True, help='YAML config file with devices to monitor')
+    parser.add_argument("-p", "--pvout", required=False, default="pvlist.txt", help="Output PV list file")
+    parser.add_argument("--prefix", default="SYNC", help="IOC prefix for PV names")
+    parser.add_argument("--bob", default="sync_profile.bob", help="Output Phoebus .bob file")
+    parser.add_argument("--polling-freq", type=float, help="Polling frequency in Hz, if not given use monitoring")
+    parser.add_argument("--publish-hz", type=positive_float, default=10.0, help="Rate in Hz at which statistics PVs are recomputed and published")
+    parser.add_argument("--mdel", type=float, default=0.0, help="Deadband: only publish a statistic when it changed by more than this since its last update")
+    parser.add_argument("--iocname", help="IOC name to display as title")
+    parser.add_argument("--loglevel", default="INFO", choices=["DEBUG", "INFO", "WARNING", "ERROR"], help="Logging level")
+    parser.add_argument("--create-display-only", action="store_true", help="Create Phoebus display file and exit without running IOC")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.loglevel.upper()), format='%(asctime)s - %(levelname)s - %(message)s')
+    # Checked by the per-update paths, so their debug messages are not even formatted at higher levels
+    log_debug = log.isEnabledFor(logging.DEBUG)
+
+    config = load_config(args.config)
+    devices = config['devices']
+    names = [d['name'] for d in devices]
+    pvs = [d['pv'] for d in devices]
+
+    log.info("Loaded %s devices from %s", len(devices), args.config)
+    log.info("Monitoring PVs:")
+    for name, pv in zip(names, pvs):
+        log.info("  %s: %s", name, pv)
+    log.info("IOC prefix: %s", args.prefix)
+    log.info("Output PV list file: %s", args.pvout)
+    if args.polling_freq:
+        log.info("Mode: Polling at %s Hz", args.polling_freq)
+    else:
+        log.info("Mode: Monitoring")
+    log.info("Publishing stats at %s Hz", args.publish_hz)
+
+    num_pvs = len(pvs)
+    window_size = 100  # Number of samples for stats
+    # Monotonic deques of (value, seq) track the windowed frequency min and max: the front
+    # is the current extreme, and an entry expires once its sample number `seq` leaves the window
+    freq_min_dqs = [deque() for _ in pvs]
+    freq_max_dqs = [deque() for _ in pvs]
+    freq_seq = [0] * num_pvs  # Number of frequency samples pushed for each PV
+    # Update times of all PVs share one ring buffer, one row per PV, so that the
+    # pairwise differences are computed for every pair with a single broadcast.
+    # Times are kept as int64 nanoseconds, built from the integer seconds and nanoseconds
+    # of the EPICS timestamp (a float64 epoch time only resolves ~256 ns), so that
+    # differences are exact; frequencies stay float64, float32 cannot hold the timestamp
+    # resolution behind them.
+    times_buf = np.zeros((num_pvs, window_size), dtype=np.int64)
+    time_head = np.zeros(num_pvs, dtype=np.int32)  # Next slot to write in each row
+    time_count = np.zeros(num_pvs, dtype=np.int32)
+    # Frequency windows are stored the same way, together with running sums so mean
+    # and std of every PV are derived in a single vectorized step
+    freq_buf = np.zeros((num_pvs, window_size), dtype=np.float64)
+    freq_head = np.zeros(num_pvs, dtype=np.int32)  # Next slot to write in each row
+    freq_count = np.zeros(num_pvs, dtype=np.int32)
+    freq_sum = np.zeros(num_pvs, dtype=np.float64)
+    freq_sumsq = np.zeros(num_pvs, dtype=np.float64)
+    # Loop-invariant index vector used by every publish
+    pv_rows = np.arange(num_pvs)
+    # Pairs (i < j) as two flat index vectors, pair k being (pair_i[k], pair_j[k]); the
+    # pair names, and so the record order, are derived from the same vectors
+    pair_i, pair_j = np.triu_indices(num_pvs, 1)
+    num_pairs = len(pair_i)
+    pair_names = [f'{names[i]}_vs_{names[j]}' for i, j in zip(pair_i.tolist(), pair_j.tolist())]
+    pair_diff_stats = make_pair_diff_stats(num_pvs, window_size, num_pairs)
+    # Stats outputs: freq_stats is instant, avg, min, max, std each indexed [idx]; pair
+    # stats are current, avg, min, max, std each indexed [k]. The *_published arrays
+    # hold the last value written to each record (NaN = never written).
+    freq_stats = np.zeros((5, num_pvs), dtype=np.float64)
+    freq_published = np.full((5, num_pvs), np.nan)
+    diff_stats_buf = np.zeros((5, num_pairs), dtype=np.float64)
+    diff_published = np.full((5, num_pairs), np.nan)
+    # PVs updated since the last publish; only they and the pairs involving them are recomputed
+    dirty = np.zeros(num_pvs, dtype=bool)
+    # Updates (idx, timestamp, integer ns timestamp) handed from the monitor callbacks to
+    # the stats thread. The stats thread alone owns the per-PV state above, so the CA
+    # callbacks return at once and no lock is needed around the buffers.
+    updates = queue.SimpleQueue()
+
+    # Set device name
+    builder.SetDeviceName(args.prefix)
+
+    # Create the output records straight into flat tables indexed like the buffers, so the
+    # hot paths need no name/key lookups: the Timestamp record of each PV, its frequency
+    # stats (instant, avg, min, max, std) and the diff stats of each pair k (current, avg,
+    # min, max, std), in DEVICE_SUFFIXES and PAIR_SUFFIXES order
+    aIn = builder.aIn
+    timestamp_records = []
+    freq_records = []
+    for name in names:
+        timestamp_records.append(aIn(f'{name}:Timestamp', initial_value=0.0, PREC=6))
+        freq_records.append(tuple(aIn(f'{name}:{suffix}', initial_value=0.0, PREC=6)
+                                  for suffix in DEVICE_SUFFIXES[1:]))
+    pair_records = [tuple(aIn(f'{pair_name}:{suffix}', initial_value=0.0, PREC=6) for suffix in PAIR_SUFFIXES)
+                    for pair_name in pair_names]
+    # The hot paths only ever call .set on them, so the bound methods are resolved once
+    set_timestamp = [rec.set for rec in timestamp_records]
+    set_freq = [tuple(rec.set for rec in recs) for recs in freq_records]
+    set_pair = [tuple(rec.set for rec in recs) for recs in pair_records]
+
+    full_names = output_pv_names(args.prefix, names, pair_names)
+    pv_list = list(full_names.values())
+
+    log.info("Created %s output PVs: stats for %s PVs and time diff stats for %s pairs", len(pv_list), num_pvs, num_pairs)
+    # The listing grows with the square of the number of PVs, so it is only built at DEBUG
+    # level and emitted as a single record
+    if log_debug:
+        lines = ["Created output PVs:"]
+        for name in names:
+            lines.append(f"  Stats for {name}: {full_names[(name, 'Timestamp')]}, InstantFreq, AvgFreq, MinFreq, MaxFreq, StdFreq")
+        for i, j, pair_name in zip(pair_i.tolist(), pair_j.tolist(), pair_names):
+            lines.append(f"  Time diff stats for {names[i]} vs {names[j]}: {full_names[(pair_name, 'CurrentDiff')]}, AvgDiff, MinDiff, MaxDiff, StdDiff")
+        log.debug("\n".join(lines))
+
+    # Generate Phoebus .bob file
+    write_display(args, names, pvs, pair_names, full_names)
 
     if args.create_display_only:
-        logging.info("Display creation complete. Exiting.")
+        log.info("Display creation complete. Exiting.")
         return
 
     def monitor_pvs():
-        def process_update(pvname, value, pv_timestamp):
-            name = pv_to_name.get(pvname)
-            logging.debug(f"name = {name}")
-            if name and pvname in data:
-                data[pvname]['times'].append(pv_timestamp)
-                logging.debug(f"Setting timestamp for {name} to {pv_timestamp}")
-                timestamp_pvs[name].set(pv_timestamp)
-                if len(data[pvname]['times']) > 1:
-                    dt = pv_timestamp - data[pvname]['times'][-2]
-                    freq = 1.0 / dt if dt > 0 else 0.0
-                    logging.debug(f"Calculated freq for {name}: dt={dt}, freq={freq}")
-                    data[pvname]['freqs'].append(freq)
-                    # Keep only recent samples
-                    if len(data[pvname]['freqs']) > window_size:
-                        data[pvname]['freqs'] = data[pvname]['freqs'][-window_size:]
-                        data[pvname]['times'] = data[pvname]['times'][-window_size:]
-                update_calculations()
-
+        # Every PV is bound to its buffer row up front, so an update is queued without
+        # looking its name up
         if args.polling_freq:
             # Polling mode
             polling_interval = 1.0 / args.polling_freq
             pv_objects = [epics.PV(pv) for pv in pvs]
             while True:
-                for pv_obj in pv_objects:
+                for idx, pv_obj in enumerate(pv_objects):
                     try:
-                        value = pv_obj.get()
+                        # A PV that has not connected yet has no value or timestamp
+                        if pv_obj.get() is None or pv_obj.timestamp is None:
+                            continue
                         timestamp = pv_obj.timestamp
-                        process_update(pv_obj.pvname, value, timestamp)
+                        updates.put((idx, timestamp, timestamp_ns(timestamp, getattr(pv_obj, 'posixseconds', None),
+                                                                  getattr(pv_obj, 'nanoseconds', None))))
                     except Exception as e:
-                        logging.error(f"Failed to poll {pv_obj.pvname}: {e}")
+                        log.error("Failed to poll %s: %s", pv_obj.pvname, e)
                 time.sleep(polling_interval)
         else:
             # Monitoring mode
-            def callback_monitor(pvname, value, **kwargs):
-                pv_timestamp = kwargs.get('timestamp', -1)
-                process_update(pvname, value, pv_timestamp)
-
-            # Connect to PVs
-            for pv in pvs:
-                logging.info(f"Starting to monitor {pv}")
+            def callback_monitor(idx, pvname, value, **kwargs):
+                timestamp = kwargs.get('timestamp', -1)
+                updates.put((idx, timestamp, timestamp_ns(timestamp, kwargs.get('posixseconds'),
+                                                          kwargs.get('nanoseconds'))))
+
+            def connection_monitor(pvname, conn, **kwargs):
+                if conn:
+                    log.info("Connected to %s", pvname)
+                else:
+                    log.warning("Disconnected from %s", pvname)
+
+            # Connect to PVs. The PV objects are owned here and subscribe with the callback
+            # as soon as they connect (and again after a reconnect), without blocking on a
+            # connection timeout for each PV in turn.
+            monitored_pvs = []
+            for idx, pv in enumerate(pvs):
+                log.info("Starting to monitor %s", pv)
                 try:
-                    epics.camonitor(pv, callback=callback_monitor)
-                    logging.info(f"Successfully set up monitor for {pv}")
+                    monitored_pvs.append(epics.PV(pv, form='time', auto_monitor=True,
+                                                  callback=functools.partial(callback_monitor, idx),
+                                                  connection_callback=connection_monitor))
                 except Exception as e:
-                    logging.error(f"Failed to monitor {pv}: {e}")
+                    log.error("Failed to monitor %s: %s", pv, e)
 
             # Keep running
             while True:
                 time.sleep(1)
 
+    def push_freq(idx, freq):
+        min_dq = freq_min_dqs[idx]
+        max_dq = freq_max_dqs[idx]
+        seq = freq_seq[idx]
+        freq_seq[idx] = seq + 1
+        head = freq_head[idx]
+        if freq_count[idx] == window_size:
+            # The slot about to be overwritten holds the oldest sample
+            old = freq_buf[idx, head]
+            freq_sum[idx] -= old
+            freq_sumsq[idx] -= old * old
+        else:
+            freq_count[idx] += 1
+        freq_buf[idx, head] = freq
+        head = (head + 1) % window_size
+        freq_head[idx] = head
+        if head == 0 and freq_count[idx] == window_size:
+            # Once per full window the running sums are recomputed from the buffer, so the
+            # rounding errors of the add/evict updates cannot accumulate (O(1) amortized)
+            row = freq_buf[idx]
+            freq_sum[idx] = row.sum()
+            freq_sumsq[idx] = row.dot(row)
+        else:
+            freq_sum[idx] += freq
+            freq_sumsq[idx] += freq * freq
+        # Older entries that can no longer be the extreme are dropped from the back
+        while min_dq and min_dq[-1][0] >= freq:
+            min_dq.pop()
+        min_dq.append((freq, seq))
+        while max_dq and max_dq[-1][0] <= freq:
+            max_dq.pop()
+        max_dq.append((freq, seq))
+        expired = seq - window_size
+        if min_dq[0][1] <= expired:
+            min_dq.popleft()
+        if max_dq[0][1] <= expired:
+            max_dq.popleft()
+
+    def reset_pv(idx):
+        # Drop all samples of PV idx; stale buffer contents are ignored once the counts are 0
+        time_head[idx] = 0
+        time_count[idx] = 0
+        freq_head[idx] = 0
+        freq_count[idx] = 0
+        freq_sum[idx] = 0.0
+        freq_sumsq[idx] = 0.0
+        freq_min_dqs[idx].clear()
+        freq_max_dqs[idx].clear()
+
+    def apply_update(idx, pv_timestamp, ts_ns):
+        if log_debug:
+            log.debug("Setting timestamp for %s to %s", names[idx], pv_timestamp)
+        set_timestamp[idx](pv_timestamp)
+        head = time_head[idx]
+        if time_count[idx]:
+            # Slot head - 1 (wrapping to the last slot) holds the previous update
+            dt_ns = ts_ns - int(times_buf[idx, head - 1])
+            if dt_ns == 0:
+                # Same timestamp as the previous update, e.g. a PV polled faster than it
+                # changes: not a new sample
+                return
+            if dt_ns < 0:
+                # The source clock went backwards (IOC restart, NTP step, timing reset):
+                # the history no longer relates to the new times, so this PV starts over
+                # with this update as its first sample
+                log.warning("Timestamp of %s went back by %s s, restarting its statistics",
+                            names[idx], -dt_ns * 1e-9)
+                reset_pv(idx)
+                head = 0
+            else:
+                dt = dt_ns * 1e-9
+                freq = 1.0 / dt
+                if log_debug:
+                    log.debug("Calculated freq for %s: dt=%s, freq=%s", names[idx], dt, freq)
+                push_freq(idx, freq)
+        times_buf[idx, head] = ts_ns
+        time_head[idx] = (head + 1) % window_size
+        if time_count[idx] < window_size:
+            time_count[idx] += 1
+        dirty[idx] = True
+
+    def process_stats():
+        # Drains the queued updates into the ring buffers and publishes the stats at most
+        # at a fixed rate, independent of the input event rate: all updates arriving within
+        # one interval coalesce into a single publish, and the thread blocks on the queue
+        # while no input PV updates
+        publish_interval = 1.0 / args.publish_hz
+        next_publish = None
+
+        # A bad update or a failed publish is logged and skipped, so that it cannot stop
+        # the thread and with it all publishing
+        def handle_update(item):
+            try:
+                apply_update(*item)
+            except Exception:
+                log.exception("Failed to process update %s", item)
+
+        while True:
+            try:
+                if next_publish is None:
+                    item = updates.get()
+                else:
+                    item = updates.get(timeout=max(next_publish - time.monotonic(), 0.0))
+            except queue.Empty:
+                item = None
+            if item is not None:
+                handle_update(item)
+                # Only what is queued right now is drained, so a flood of updates cannot
+                # postpone the publish indefinitely
+                for _ in range(updates.qsize()):
+                    handle_update(updates.get_nowait())
+                if next_publish is None:
+                    next_publish = time.monotonic() + publish_interval
+            if next_publish is not None and time.monotonic() >= next_publish:
+                next_publish = None
+                try:
+                    update_calculations()
+                except Exception:
+                    log.exception("Failed to publish stats")
+
     def update_calculations():
-        # Update frequency stats for each PV
-        for name in names:
-            pv = name_to_pv[name]
-            freqs = data[pv]['freqs']
-            logging.debug(f"Updating calculations for {name}, freqs = {freqs}")
-            if freqs:
-                instant_freq = freqs[-1]
-                avg_freq = np.mean(freqs)
-                min_freq = np.min(freqs)
-                max_freq = np.max(freqs)
-                std_freq = np.std(freqs)
-
-                logging.debug(f"Setting {args.prefix}:{name}:InstantFreq = {instant_freq}")
-                freq_pvs[name]['instant'].set(instant_freq)
-                freq_pvs[name]['avg'].set(avg_freq)
-                freq_pvs[name]['min'].set(min_freq)
-                freq_pvs[name]['max'].set(max_freq)
-                freq_pvs[name]['std'].set(std_freq)
-
-        # Update diff stats for each pair
-        for i in range(num_pvs):
-            for j in range(i+1, num_pvs):
-                name1 = names[i]
-                name2 = names[j]
-                pv1 = name_to_pv[name1]
-                pv2 = name_to_pv[name2]
-                times1 = data[pv1]['times']
-                times2 = data[pv2]['times']
-                if times1 and times2:
-                    # Current diff based on latest update times
-                    current_diff = times1[-1] - times2[-1]
-                    # For stats, use paired diffs (zip stops at shorter list)
-                    diffs = [t1 - t2 for t1, t2 in zip(times1, times2)]
-                    if diffs:
-                        avg_diff = np.mean(diffs)
-                        min_diff = np.min(diffs)
-                        max_diff = np.max(diffs)
-                        std_diff = np.std(diffs)
-
-                        diff_pvs[(i, j)]['current'].set(current_diff)
-                        diff_pvs[(i, j)]['avg'].set(avg_diff)
-                        diff_pvs[(i, j)]['min'].set(min_diff)
-                        diff_pvs[(i, j)]['max'].set(max_diff)
-                        diff_pvs[(i, j)]['std'].set(std_diff)
+        dirty_pvs = np.flatnonzero(dirty)
+        if not len(dirty_pvs):
+            return
+        updated = dirty & (freq_count > 0)
+        dirty_pairs = np.flatnonzero(dirty[pair_i] | dirty[pair_j])
+        dirty[:] = False
+
+        # Update frequency stats for all PVs at once
+        freq_stats[0] = freq_buf[pv_rows, (freq_head - 1) % window_size]
+        freq_stats[2] = [dq[0][0] if dq else 0.0 for dq in freq_min_dqs]
+        freq_stats[3] = [dq[0][0] if dq else 0.0 for dq in freq_max_dqs]
+        counts = np.maximum(freq_count, 1)
+        freq_stats[1] = freq_sum / counts
+        # Clamp tiny negative variances caused by floating-point cancellation
+        freq_stats[4] = np.sqrt(np.maximum(freq_sumsq / counts - freq_stats[1] * freq_stats[1], 0.0))
+
+        # Update diff stats only for the pairs involving an updated PV
+        sub_i = pair_i[dirty_pairs]
+        sub_j = pair_j[dirty_pairs]
+        diff_stats = diff_stats_buf[:, :len(dirty_pairs)]
+        pair_diff_stats(times_buf, time_head, time_count, sub_i, sub_j, diff_stats)
+        n_pair = np.minimum(time_count[sub_i], time_count[sub_j])
+
+        # Only write records whose value moved by more than the deadband since it was
+        # last written; steady-state PVs then cost no record processing or CA traffic
+        freq_changed = ~(np.abs(freq_stats - freq_published) <= args.mdel) & updated
+        values = freq_stats.tolist()
+        changed = freq_changed.tolist()
+        for idx in dirty_pvs.tolist():
+            if log_debug:
+                log.debug("Updating calculations for %s, count = %s", names[idx], freq_count[idx])
+            for stat, set_stat in enumerate(set_freq[idx]):
+                if changed[stat][idx]:
+                    set_stat(values[stat][idx])
+        np.copyto(freq_published, freq_stats, where=freq_changed)
+
+        last_published = diff_published[:, dirty_pairs]
+        diff_changed = ~(np.abs(diff_stats - last_published) <= args.mdel) & (n_pair > 0)
+        values = diff_stats.tolist()
+        changed = diff_changed.tolist()
+        for pos, k in enumerate(dirty_pairs.tolist()):
+            for stat, set_stat in enumerate(set_pair[k]):
+                if changed[stat][pos]:
+                    set_stat(values[stat][pos])
+        diff_published[:, dirty_pairs] = np.where(diff_changed, diff_stats, last_published)
 
     # Boilerplate get the IOC started
     builder.LoadDatabase()
@@ -419,15 +720,14 @@ def main():
     monitor_thread = threading.Thread(target=monitor_pvs)
     monitor_thread.daemon = True
     monitor_thread.start()
+    stats_thread = threading.Thread(target=process_stats)
+    stats_thread.daemon = True
+    stats_thread.start()
 
-    # Write PV list to file
-    import os
+    # Write PV list to file; the records are all built here, so their names are already
+    # known and the IOC's dbl output does not need to be captured
     with open(args.pvout, "w") as f:
-        old_stdout = os.dup(1)
-        os.dup2(f.fileno(), 1)
-        softioc.dbl()
-        os.dup2(old_stdout, 1)
-        os.close(old_stdout)
+        f.write("\n".join(pv_list) + "\n")
 
     # Leave the IOC running with an interactive shell.
     softioc.interactive_ioc(globals())